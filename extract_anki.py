@@ -9,10 +9,37 @@ Format: Front\tBack\tTags
 import re
 import os
 import html
+import mmap
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from pathlib import Path
 
 WORKSPACE = Path(__file__).parent
-ENV_TYPES = ["theorem", "proposition", "definition", "lemma", "corollary"]
+MACRO_CACHE_PATH = WORKSPACE / '_macro_cache.pkl'
+ENV_TYPES = ("theorem", "proposition", "definition", "lemma", "corollary")
+ENV_TYPE_LABELS = {env: env.capitalize() for env in ENV_TYPES}
+# Anki import header comments
+ANKI_HEADER = (
+    '#separator:tab\n'
+    '#html:true\n'
+    '#tags column:3\n'
+    '#deck:Lecture Notes\n'
+)
+
+
+_NEWCOMMAND_RE = re.compile(
+    r'\\(?:re)?newcommand\{(\\[a-zA-Z]+)\}'
+    r'(?:\[(\d)\])?'
+    r'\{(.+?)\}\s*$',
+    re.MULTILINE
+)
+_MATH_OPERATOR_RE = re.compile(r'\\DeclareMathOperator\{(\\[a-zA-Z]+)\}\{([^}]+)\}')
+_DOCUMENT_COMMAND_RE = re.compile(r'\\DeclareDocumentCommand\\([a-zA-Z]+)\{\}\{([^}]+)\}')
+_PAIRED_DELIMITER_RE = re.compile(
+    r'\\DeclarePairedDelimiter\\([a-zA-Z]+)\{([^}]+)\}\{([^}]+)\}'
+)
 
 
 def parse_macros(tex_source):
@@ -24,40 +51,26 @@ def parse_macros(tex_source):
 
     # \newcommand{\name}[n]{replacement} or \newcommand{\name}{replacement}
     # Also handles \renewcommand
-    for m in re.finditer(
-        r'\\(?:re)?newcommand\{(\\[a-zA-Z]+)\}'
-        r'(?:\[(\d)\])?'
-        r'\{(.+?)\}\s*$',
-        tex_source, re.MULTILINE
-    ):
+    for m in _NEWCOMMAND_RE.finditer(tex_source):
         name = m.group(1)  # e.g. \R
         num_args = int(m.group(2)) if m.group(2) else 0
         replacement = m.group(3)
         macros.append((name, num_args, replacement))
 
     # \DeclareMathOperator{\name}{text}
-    for m in re.finditer(
-        r'\\DeclareMathOperator\{(\\[a-zA-Z]+)\}\{([^}]+)\}',
-        tex_source
-    ):
+    for m in _MATH_OPERATOR_RE.finditer(tex_source):
         name = m.group(1)
         replacement = r'\operatorname{' + m.group(2) + '}'
         macros.append((name, 0, replacement))
 
     # \DeclareDocumentCommand\name{}{replacement}
-    for m in re.finditer(
-        r'\\DeclareDocumentCommand\\([a-zA-Z]+)\{\}\{([^}]+)\}',
-        tex_source
-    ):
+    for m in _DOCUMENT_COMMAND_RE.finditer(tex_source):
         name = '\\' + m.group(1)
         replacement = m.group(2)
         macros.append((name, 0, replacement))
 
     # \DeclarePairedDelimiter\name{left}{right}  -> \left<left> #1 \right<right>
-    for m in re.finditer(
-        r'\\DeclarePairedDelimiter\\([a-zA-Z]+)\{([^}]+)\}\{([^}]+)\}',
-        tex_source
-    ):
+    for m in _PAIRED_DELIMITER_RE.finditer(tex_source):
         name = '\\' + m.group(1)
         left = m.group(2)
         right = m.group(3)
@@ -67,132 +80,268 @@ def parse_macros(tex_source):
     return macros
 
 
-def expand_macros(text, macros):
+# Compiled macro regexes keyed by the macro list they were built from
+_compiled_macros = {}
+
+
+def compile_macros(macros):
+    """Compile (name, num_args, replacement) tuples into (pattern, replacer)
+    pairs, one per arity, so that each expansion pass makes a single scan
+    per arity rather than one per macro. Returns (max_passes, pairs).
+    Results are memoized, so files sharing the same macros share the regexes.
+    """
+    key = tuple(macros)
+    if key not in _compiled_macros:
+        _compiled_macros[key] = _compile_macros(key)
+    return _compiled_macros[key]
+
+
+def _compile_macros(macros):
+    # Earlier definitions take precedence, as header.sty is loaded first; a
+    # redefinition is dropped even if it has a different number of arguments
+    definitions = {}
+    for name, num_args, replacement in macros:
+        definitions.setdefault(name, (num_args, replacement))
+    by_arity = {0: {}, 1: {}, 2: {}}
+    for name, (num_args, replacement) in definitions.items():
+        if num_args in by_arity:
+            by_arity[num_args][name] = replacement
+
+    def alternation(names):
+        # Longest names first so that e.g. \RR is not shadowed by \R
+        names = sorted(names, key=len, reverse=True)
+        return '(' + '|'.join(re.escape(n) for n in names) + ')'
+
+    compiled = []
+    zero, one, two = by_arity[0], by_arity[1], by_arity[2]
+    if zero:
+        # Simple replacement: \name followed by non-alpha (or end)
+        pattern = re.compile(alternation(zero) + r'(?![a-zA-Z])')
+        def replacer(m):
+            return zero[m.group(1)]
+        compiled.append((pattern, replacer))
+    if one:
+        # \name{arg}
+        pattern = re.compile(alternation(one) + r'\{([^}]*)\}')
+        def replacer(m):
+            return one[m.group(1)].replace('#1', m.group(2))
+        compiled.append((pattern, replacer))
+    if two:
+        # \name{arg1}{arg2}
+        pattern = re.compile(alternation(two) + r'\{([^}]*)\}\{([^}]*)\}')
+        def replacer(m):
+            return two[m.group(1)].replace('#1', m.group(2)).replace('#2', m.group(3))
+        compiled.append((pattern, replacer))
+    # Each pass expands one level of nesting, so an acyclic chain of macros
+    # needs at most one pass per macro, plus one to confirm the fixed point
+    return len(definitions) + 1, compiled
+
+
+def expand_macros(text, compiled_macros):
     """Expand custom LaTeX macros in text.
     Applies expansions repeatedly to handle macros that reference other macros.
+    Takes the output of compile_macros().
     """
-    for _ in range(3):  # multiple passes for nested macro refs
-        for name, num_args, replacement in macros:
-            escaped_name = re.escape(name)
-            if num_args == 0:
-                # Simple replacement: \name followed by non-alpha (or end)
-                pattern = escaped_name + r'(?![a-zA-Z])'
-
-                text = re.sub(pattern, lambda m, r=replacement: r, text)
-            elif num_args == 1:
-                # \name{arg}
-                pattern = escaped_name + r'\{([^}]*)\}'
-                def make_replacer(repl):
-                    def replacer(m):
-                        return repl.replace('#1', m.group(1))
-                    return replacer
-                text = re.sub(pattern, make_replacer(replacement), text)
-            elif num_args == 2:
-                # \name{arg1}{arg2}
-                pattern = escaped_name + r'\{([^}]*)\}\{([^}]*)\}'
-                def make_replacer2(repl):
-                    def replacer(m):
-                        return repl.replace('#1', m.group(1)).replace('#2', m.group(2))
-                    return replacer
-                text = re.sub(pattern, make_replacer2(replacement), text)
+    max_passes, patterns = compiled_macros
+    for _ in range(max_passes):  # multiple passes for nested macro refs
+        if '\\' not in text:
+            break  # no control sequences left to expand
+        expanded = 0
+        for pattern, replacer in patterns:
+            text, count = pattern.subn(replacer, text)
+            expanded += count
+        if not expanded:
+            break  # a pass that changes nothing is a fixed point
     return text
 
 
+# Parsed macros keyed by file path, each stored with the (mtime, size) it was parsed at
+_macro_cache = None
+
+
+def _get_macro_cache():
+    global _macro_cache
+    if _macro_cache is None:
+        try:
+            with open(MACRO_CACHE_PATH, 'rb') as f:
+                _macro_cache = pickle.load(f)
+        except Exception:
+            # Missing, truncated or otherwise unreadable: start afresh
+            _macro_cache = None
+        if not isinstance(_macro_cache, dict):
+            _macro_cache = {}
+    return _macro_cache
+
+
+def save_macro_cache():
+    """Write parsed macros to disk so unchanged files are not reparsed next run."""
+    if _macro_cache is not None:
+        # Write alongside and swap in, so an interrupted save can't truncate it
+        tmp_path = MACRO_CACHE_PATH.with_name(MACRO_CACHE_PATH.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(_macro_cache, f)
+        os.replace(tmp_path, MACRO_CACHE_PATH)
+
+
+def _cached_parse_macros(path, read_source):
+    """Return parse_macros(read_source()), reusing the cached result if the
+    file's mtime and size are unchanged since it was last parsed.
+    """
+    cache = _get_macro_cache()
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    key = str(path)
+    entry = cache.get(key)
+    if isinstance(entry, tuple) and len(entry) == 2 and entry[0] == stamp:
+        return entry[1]
+    macros = parse_macros(read_source())
+    cache[key] = (stamp, macros)
+    return macros
+
+
 def load_global_macros():
     """Load macros from header.sty."""
     header_path = WORKSPACE / 'header.sty'
     if header_path.exists():
-        with open(header_path, 'r', encoding='utf-8') as f:
-            return parse_macros(f.read())
+        def read_source():
+            with open(header_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        return _cached_parse_macros(header_path, read_source)
     return []
 
 
-def load_file_macros(filepath):
-    """Load macros from a .tex file's preamble (before \begin{document})."""
-    with open(filepath, 'r', encoding='utf-8') as f:
-        content = f.read()
-    # Only look at preamble
-    doc_start = content.find(r'\begin{document}')
-    if doc_start != -1:
-        preamble = content[:doc_start]
-    else:
-        preamble = content
-    return parse_macros(preamble)
+def _decode(buf):
+    """Decode UTF-8 bytes with universal newlines, as reading in text mode would."""
+    text = str(buf, 'utf-8')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+@contextmanager
+def _map_file(filepath):
+    """Memory-map a file read-only, yielding b'' for an empty file (which
+    mmap cannot map).
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+
+def _read_preamble(buf):
+    """Decode only the part of buf before \\begin{document}."""
+    doc_start = buf.find(b'\\begin{document}')
+    if doc_start == -1:
+        return _decode(buf)
+    # Decode through a memoryview so the preamble bytes are not copied first
+    with memoryview(buf) as view:
+        with view[:doc_start] as preamble:
+            return _decode(preamble)
 
 
-# Regex to match \begin{env}...\end{env} (non-greedy, handles nesting by using a parser)
-# We'll use a manual parser for robustness with nested environments.
+def load_file_macros(filepath, buf=None):
+    """Load macros from a .tex file's preamble (before \begin{document}).
+
+    If the file's contents are already available as a bytes-like buf (e.g. an
+    mmap), the preamble is sliced out of it instead of reading the file again.
+    Either way the body of the document is never decoded.
+    """
+    def read_source():
+        if buf is not None:
+            return _read_preamble(buf)
+        with _map_file(filepath) as mm:
+            return _read_preamble(mm)
+    return _cached_parse_macros(filepath, read_source)
+
+
+@lru_cache(maxsize=None)
+def _env_token_re(env_types):
+    """Build a regex matching any \\begin{env} or \\end{env} of the given types.
+    env_types must be a tuple; each distinct set is compiled only once.
+    """
+    return re.compile(
+        r'\\(begin|end)\{(' + '|'.join(re.escape(e) for e in env_types) + r')\}'
+    )
+
 
 def find_environments(tex_content, env_types):
-    """Find all environments of the given types, handling nesting correctly."""
-    results = []
-    for env in env_types:
-        pattern_begin = re.compile(r'\\begin\{' + env + r'\}')
-        pos = 0
-        while True:
-            m = pattern_begin.search(tex_content, pos)
-            if not m:
-                break
-            start = m.start()
-            content_start = m.end()
-            # Now find the matching \end{env}, handling nested \begin{env}
-            depth = 1
-            search_pos = content_start
-            end_pos = None
-            while depth > 0:
-                next_begin = re.search(r'\\begin\{' + env + r'\}', tex_content[search_pos:])
-                next_end = re.search(r'\\end\{' + env + r'\}', tex_content[search_pos:])
-                if next_end is None:
-                    break  # malformed
-                if next_begin and next_begin.start() < next_end.start():
-                    depth += 1
-                    search_pos += next_begin.end()
-                else:
-                    depth -= 1
-                    if depth == 0:
-                        end_pos = search_pos + next_end.start()
-                    search_pos += next_end.end()
-            if end_pos is not None:
-                body = tex_content[content_start:end_pos].strip()
-                results.append((env, body, start))
-            pos = content_start
-    # Sort by position in file
-    results.sort(key=lambda x: x[2])
-    return results
+    """Find all environments of the given types, handling nesting correctly.
+
+    Makes a single pass over the begin/end tokens, keeping a stack of open
+    environments per type so that nested environments are matched up. Each
+    environment reserves its result slot when it opens, so results come out
+    in file order without sorting.
+    """
+    token_re = _env_token_re(tuple(env_types))
+    slots = []
+    open_envs = {env: [] for env in env_types}
+    for m in token_re.finditer(tex_content):
+        kind, env = m.group(1), m.group(2)
+        stack = open_envs[env]
+        if kind == 'begin':
+            stack.append((len(slots), m.start(), m.end()))
+            slots.append(None)
+        elif stack:
+            slot, start, content_start = stack.pop()
+            body = tex_content[content_start:m.start()].strip()
+            slots[slot] = (env, body, start)
+    # Drop environments that were never closed
+    return [result for result in slots if result is not None]
+
+
+_SECTION_RE = re.compile(r'\\(section|subsection|subsubsection)\{([^}]+)\}')
 
 
 def find_sections(tex_content):
     """Find all section/subsection headings with their positions."""
-    pattern = re.compile(r'\\(section|subsection|subsubsection)\{([^}]+)\}')
     sections = []
-    for m in pattern.finditer(tex_content):
+    for m in _SECTION_RE.finditer(tex_content):
         sections.append((m.start(), m.group(1), m.group(2)))
     return sections
 
 
-def get_section_context(pos, sections):
-    """Get the section/subsection context for a given position."""
+SECTION_HIERARCHY = ["section", "subsection", "subsubsection"]
+
+
+def get_section_contexts(positions, sections):
+    """Get the section/subsection context for each of the given positions.
+
+    Both positions and sections must be sorted by position, so the two can be
+    walked together in a single pass.
+    """
+    contexts = []
     current = {}
-    hierarchy = ["section", "subsection", "subsubsection"]
-    for sec_pos, sec_type, sec_title in sections:
-        if sec_pos > pos:
-            break
-        current[sec_type] = sec_title
-        # Clear lower-level sections when a higher-level one is set
-        idx = hierarchy.index(sec_type)
-        for lower in hierarchy[idx + 1:]:
-            current.pop(lower, None)
-    parts = []
-    for level in hierarchy:
-        if level in current:
-            parts.append(current[level])
-    return " > ".join(parts) if parts else ""
+    parts = ""
+    i = 0
+    for pos in positions:
+        changed = False
+        while i < len(sections) and sections[i][0] <= pos:
+            _, sec_type, sec_title = sections[i]
+            current[sec_type] = sec_title
+            # Clear lower-level sections when a higher-level one is set
+            idx = SECTION_HIERARCHY.index(sec_type)
+            for lower in SECTION_HIERARCHY[idx + 1:]:
+                current.pop(lower, None)
+            changed = True
+            i += 1
+        if changed:
+            parts = " > ".join(
+                current[level] for level in SECTION_HIERARCHY if level in current
+            )
+        contexts.append(parts)
+    return contexts
+
+
+# A title in parentheses at the very start, possibly after whitespace/newlines
+_TITLE_RE = re.compile(r'\s*\(([^)]+)\)')
 
 
 def extract_title_from_body(body):
     """Extract a parenthesized title from the beginning of the body, e.g. '(Cauchy's theorem)'."""
-    # Match a title in parentheses at the very start, possibly with whitespace/newline
-    m = re.match(r'\s*\(([^)]+)\)', body)
+    m = _TITLE_RE.match(body)
     if m:
         title = m.group(1).strip()
         remaining = body[m.end():].strip()
@@ -200,6 +349,120 @@ def extract_title_from_body(body):
     return None, body
 
 
+_ALIGN_BEGIN_RE = re.compile(r'\\begin\{align\*?\}')
+_ALIGN_END_RE = re.compile(r'\\end\{align\*?\}')
+_EQUATION_BEGIN_RE = re.compile(r'\\begin\{equation\*?\}')
+_EQUATION_END_RE = re.compile(r'\\end\{equation\*?\}')
+_ENUMERATE_BEGIN_RE = re.compile(r'\\begin\{enumerate\}(?:\[[^\]]*\])?')
+_ENUMERATE_END_RE = re.compile(r'\\end\{enumerate\}')
+_ITEMIZE_BEGIN_RE = re.compile(r'\\begin\{itemize\}')
+_ITEMIZE_END_RE = re.compile(r'\\end\{itemize\}')
+_ITEM_RE = re.compile(r'\\item\s*')
+# A newline together with any other whitespace on either side of it
+_NEWLINE_RE = re.compile(r'[^\S\n]*\n[^\S\n]*')
+_BR_RUN_RE = re.compile(r'(?:<br>){3,}')
+
+
+def _replace_environment(text, begin_re, end_re, convert):
+    """Replace each begin...end span with convert(content).
+
+    The closing tag is found with a direct search from the opening tag, so
+    each pass is linear in the length of text. Like a lazy regex, the first
+    closing tag after an opening one ends the span.
+    """
+    parts = []
+    pos = 0
+    while True:
+        begin = begin_re.search(text, pos)
+        if not begin:
+            break
+        end = end_re.search(text, begin.end())
+        if not end:
+            break
+        parts.append(text[pos:begin.start()])
+        parts.append(convert(text[begin.end():end.start()]))
+        pos = end.end()
+    if not parts:
+        return text  # nothing to convert, so avoid copying
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def _convert_display_dollars(text):
+    """Convert $$...$$ to \\[...\\]."""
+    parts = []
+    pos = 0
+    while True:
+        start = text.find('$$', pos)
+        if start == -1:
+            break
+        end = text.find('$$', start + 2)
+        if end == -1:
+            break
+        parts.append(text[pos:start])
+        parts.append(r'\[' + text[start + 2:end] + r'\]')
+        pos = end + 2
+    if not parts:
+        return text  # nothing to convert, so avoid copying
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def _find_lone_dollar(text, pos):
+    """Index of the next $ at or after pos that is not part of a $$ run, or -1."""
+    n = len(text)
+    while True:
+        i = text.find('$', pos)
+        if i == -1:
+            return -1
+        if (i == 0 or text[i - 1] != '$') and (i + 1 == n or text[i + 1] != '$'):
+            return i
+        pos = i + 1
+
+
+def _convert_inline_dollars(text):
+    """Convert $...$ (single $, not $$) to \\(...\\)."""
+    parts = []
+    pos = 0
+    while True:
+        start = _find_lone_dollar(text, pos)
+        if start == -1:
+            break
+        end = _find_lone_dollar(text, start + 1)
+        if end == -1:
+            break
+        parts.append(text[pos:start])
+        parts.append(r'\(' + text[start + 1:end] + r'\)')
+        pos = end + 1
+    if not parts:
+        return text  # nothing to convert, so avoid copying
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def _wrap_command(text, cmd, open_tag, close_tag):
+    """Replace \\cmd{...} with open_tag...close_tag. The argument runs to the
+    first closing brace, so nested braces are not supported.
+    """
+    prefix = '\\' + cmd + '{'
+    parts = []
+    pos = 0
+    while True:
+        start = text.find(prefix, pos)
+        if start == -1:
+            break
+        end = text.find('}', start + len(prefix))
+        if end == -1:
+            break
+        parts.append(text[pos:start])
+        parts.append(open_tag + text[start + len(prefix):end] + close_tag)
+        pos = end + 1
+    if not parts:
+        return text  # nothing to convert, so avoid copying
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
 def latex_to_anki_mathjax(text):
     """Convert LaTeX math delimiters to Anki-compatible MathJax/HTML format.
     
@@ -212,117 +475,104 @@ def latex_to_anki_mathjax(text):
     
     # Convert display math environments to \[...\]
     # align* -> \[ \begin{aligned}...\end{aligned} \]
-    text = re.sub(
-        r'\\begin\{align\*?\}(.*?)\\end\{align\*?\}',
-        lambda m: r'\[\begin{aligned}' + m.group(1) + r'\end{aligned}\]',
-        text, flags=re.DOTALL
+    text = _replace_environment(
+        text, _ALIGN_BEGIN_RE, _ALIGN_END_RE,
+        lambda content: r'\[\begin{aligned}' + content + r'\end{aligned}\]'
     )
     # equation* -> \[...\]
-    text = re.sub(
-        r'\\begin\{equation\*?\}(.*?)\\end\{equation\*?\}',
-        lambda m: r'\[' + m.group(1) + r'\]',
-        text, flags=re.DOTALL
+    text = _replace_environment(
+        text, _EQUATION_BEGIN_RE, _EQUATION_END_RE,
+        lambda content: r'\[' + content + r'\]'
     )
     
     # Convert enumerate to HTML lists
-    def convert_enumerate(match):
-        content = match.group(1)
-        items = re.split(r'\\item\s*', content)
+    def convert_enumerate(content):
+        items = _ITEM_RE.split(content)
         items = [i.strip() for i in items if i.strip()]
         html_items = ''.join(f'<li>{item}</li>' for item in items)
         return f'<ol>{html_items}</ol>'
     
-    text = re.sub(
-        r'\\begin\{enumerate\}(?:\[[^\]]*\])?(.*?)\\end\{enumerate\}',
-        convert_enumerate, text, flags=re.DOTALL
+    text = _replace_environment(
+        text, _ENUMERATE_BEGIN_RE, _ENUMERATE_END_RE, convert_enumerate
     )
     
     # Convert itemize to HTML lists
-    def convert_itemize(match):
-        content = match.group(1)
-        items = re.split(r'\\item\s*', content)
+    def convert_itemize(content):
+        items = _ITEM_RE.split(content)
         items = [i.strip() for i in items if i.strip()]
         html_items = ''.join(f'<li>{item}</li>' for item in items)
         return f'<ul>{html_items}</ul>'
     
-    text = re.sub(
-        r'\\begin\{itemize\}(.*?)\\end\{itemize\}',
-        convert_itemize, text, flags=re.DOTALL
+    text = _replace_environment(
+        text, _ITEMIZE_BEGIN_RE, _ITEMIZE_END_RE, convert_itemize
     )
     
     # Convert math delimiters to Anki MathJax-compatible format
     # First: display math $$...$$ -> \[...\]  (must come before inline $...$)
-    text = re.sub(
-        r'\$\$(.*?)\$\$',
-        lambda m: r'\[' + m.group(1) + r'\]',
-        text, flags=re.DOTALL
-    )
+    text = _convert_display_dollars(text)
     # Display math \[...\] is already correct for MathJax — leave as-is
     
     # Inline math $...$ -> \(...\)  (single $, not $$)
-    # Match $ that is not preceded/followed by another $
-    text = re.sub(
-        r'(?<!\$)\$(?!\$)(.*?)(?<!\$)\$(?!\$)',
-        lambda m: r'\(' + m.group(1) + r'\)',
-        text, flags=re.DOTALL
-    )
+    text = _convert_inline_dollars(text)
     
     # Remove \textit{...} -> <i>...</i>
-    text = re.sub(r'\\textit\{([^}]*)\}', r'<i>\1</i>', text)
-    text = re.sub(r'\\textbf\{([^}]*)\}', r'<b>\1</b>', text)
-    text = re.sub(r'\\emph\{([^}]*)\}', r'<i>\1</i>', text)
+    text = _wrap_command(text, 'textit', '<i>', '</i>')
+    text = _wrap_command(text, 'textbf', '<b>', '</b>')
+    text = _wrap_command(text, 'emph', '<i>', '</i>')
     
-    # Clean up multiple blank lines and convert to <br>
-    lines = text.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        stripped = line.strip()
-        cleaned_lines.append(stripped)
-    
-    text = '<br>'.join(cleaned_lines)
+    # Strip whitespace around each line and convert newlines to <br>
+    text = _NEWLINE_RE.sub('<br>', text.strip())
     # Remove excessive <br> sequences
-    text = re.sub(r'(<br>){3,}', '<br><br>', text)
+    text = _BR_RUN_RE.sub('<br><br>', text)
     # Remove leading/trailing <br>
-    text = text.strip('<br>')
-    text = re.sub(r'^(<br>)+', '', text)
-    text = re.sub(r'(<br>)+$', '', text)
-    
-    return text.strip()
+    return text.strip('<br>').strip()
 
 
+@lru_cache(maxsize=256)
 def get_course_name(filepath):
     """Extract course name from the directory name."""
     return filepath.parent.name
 
 
+@lru_cache(maxsize=1024)
 def sanitize_tag(text):
     """Make a string safe for use as an Anki tag (no spaces, special chars)."""
     return text.replace(' ', '_').replace(',', '').replace('&', 'and')
 
 
+ENV_TAGS = {env: sanitize_tag(env) for env in ENV_TYPES}
+
+
 def process_file(filepath, global_macros):
-    """Process a single .tex file and return flashcard entries."""
-    with open(filepath, 'r', encoding='utf-8') as f:
-        content = f.read()
+    """Process a single .tex file, yielding (front, back, tags) flashcard entries."""
+    # Map the file once and reuse it for both the preamble and the body
+    with _map_file(filepath) as mm:
+        content = _decode(mm)
+        file_macros = load_file_macros(filepath, mm)
     
     course = get_course_name(filepath)
-    file_macros = load_file_macros(filepath)
-    all_macros = global_macros + file_macros
+    all_macros = compile_macros(global_macros + file_macros)
     
     sections = find_sections(content)
     environments = find_environments(content, ENV_TYPES)
     
-    cards = []
-    for env_type, body, pos in environments:
+    section_contexts = get_section_contexts(
+        [pos for _, _, pos in environments], sections
+    )
+    
+    # Per-file parts of every card
+    course_label = f"<br><i>[{course}]</i>"
+    course_tag = sanitize_tag(course)
+    
+    for (env_type, body, _), section_ctx in zip(environments, section_contexts):
         title, clean_body = extract_title_from_body(body)
         # Expand custom macros before converting
         clean_body = expand_macros(clean_body, all_macros)
         if title:
             title = expand_macros(title, all_macros)
-        section_ctx = get_section_context(pos, sections)
         
         # Build the front of the card
-        type_label = env_type.capitalize()
+        type_label = ENV_TYPE_LABELS[env_type]
         if title:
             front = f"<b>{type_label}</b>: {title}"
         else:
@@ -331,27 +581,34 @@ def process_file(filepath, global_macros):
             if section_ctx:
                 front += f" ({section_ctx})"
         
-        front += f"<br><i>[{course}]</i>"
+        front += course_label
         
         # Build the back of the card
         back = latex_to_anki_mathjax(clean_body)
         
         # Tags
-        tags = [sanitize_tag(course), sanitize_tag(env_type)]
+        tag_str = f"{course_tag} {ENV_TAGS[env_type]}"
         if section_ctx:
             # Add top-level section as tag
-            top_section = section_ctx.split(' > ')[0]
-            tags.append(sanitize_tag(top_section))
-        
-        tag_str = ' '.join(tags)
+            top_section = section_ctx.split(' > ', 1)[0]
+            tag_str += f" {sanitize_tag(top_section)}"
         
-        cards.append((front, back, tag_str))
-    
-    return cards
+        yield front, back, tag_str
+
+
+def format_cards(filepath, global_macros):
+    """Process a single .tex file and return its card count and TSV rows.
+    Runs in worker processes, so only one string per file is sent back.
+    """
+    # Escape any tabs in content
+    rows = [
+        f"{front.replace(chr(9), ' ')}\t{back.replace(chr(9), ' ')}\t{tags}\n"
+        for front, back, tags in process_file(filepath, global_macros)
+    ]
+    return len(rows), ''.join(rows)
 
 
 def main():
-    all_cards = []
     tex_files = sorted(WORKSPACE.rglob('main.tex'))
     global_macros = load_global_macros()
     print(f"Loaded {len(global_macros)} global macros from header.sty")
@@ -361,27 +618,32 @@ def main():
         course = get_course_name(f)
         print(f"  - {course}")
     
+    # Parse preambles up front so worker processes start from a warm macro cache
     for filepath in tex_files:
-        course = get_course_name(filepath)
-        cards = process_file(filepath, global_macros)
-        print(f"  {course}: {len(cards)} cards extracted")
-        all_cards.extend(cards)
+        load_file_macros(filepath)
+    save_macro_cache()
     
-    # Write TSV file for Anki import
+    # Write TSV file for Anki import, streaming each file's cards as they arrive
     output_path = WORKSPACE / 'anki_flashcards.txt'
-    with open(output_path, 'w', encoding='utf-8') as f:
-        # Anki import header comments
-        f.write('#separator:tab\n')
-        f.write('#html:true\n')
-        f.write('#tags column:3\n')
-        f.write('#deck:Lecture Notes\n')
-        for front, back, tags in all_cards:
-            # Escape any tabs in content
-            front_clean = front.replace('\t', ' ')
-            back_clean = back.replace('\t', ' ')
-            f.write(f'{front_clean}\t{back_clean}\t{tags}\n')
+    # Stream into a temporary file so a failure part-way leaves the old deck intact
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    total = 0
+    with open(tmp_path, 'w', encoding='utf-8', buffering=1 << 20) as out:
+        out.write(ANKI_HEADER)
+        # Files are independent, so process them in parallel
+        with ProcessPoolExecutor() as executor:
+            results = executor.map(
+                partial(format_cards, global_macros=global_macros),
+                tex_files, chunksize=1
+            )
+            for filepath, (count, rows) in zip(tex_files, results):
+                course = get_course_name(filepath)
+                print(f"  {course}: {count} cards extracted")
+                out.write(rows)
+                total += count
+    os.replace(tmp_path, output_path)
     
-    print(f"\nTotal: {len(all_cards)} flashcards exported to {output_path}")
+    print(f"\nTotal: {total} flashcards exported to {output_path}")
     print("Import into Anki: File > Import > select anki_flashcards.txt")
     print("Make sure MathJax is enabled in Anki (it is by default in Anki 2.1.54+)")
 